@@ -1,8 +1,8 @@
+from collections import OrderedDict
 import numpy as np
 import netCDF4
 import os
 import re
-import calendar
 import datetime as dt
 import logging
 
@@ -12,6 +12,138 @@ from hyo2.soundspeed import __version__ as ssp_version
 from hyo2.soundspeed import __doc__ as ssp_name
 from hyo2.soundspeed.formats.writers.abstract import AbstractWriter
 from hyo2.soundspeed.profile.dicts import Dicts
+from hyo2.soundspeed.profile.profilelist import ProfileList
+
+
+# constant global attributes and attributes of the output variables
+
+_GLOBAL_ATTRS = OrderedDict([
+    ('ncei_template_version', 'NCEI_NetCDF_Profile_Orthogonal_Template_v2.0'),  # REQUIRED(NCEI)
+    ('featureType', 'profile'),  # REQUIRED - CF attribute for identifying the featureType.(CF)
+    # SUGGESTED - The data type, as derived from Unidata's Common Data Model Scientific Data types and understood
+    # by THREDDS. (ACDD)
+    ('cdm_data_type', 'profile'),
+    # HIGHLY RECOMMENDED - Provide a useful summary or abstract for the data in the file.(ACDD)
+    # ('summary', ''),
+    # HIGHLY RECOMMENDED - A comma separated list of keywords coming from the keywords_vocabulary.(ACDD)
+    # ('keywords', ''),
+    # HIGHLY RECOMMENDED - A comma separated list of the conventions being followed. Always try to use latest
+    # version.(CF / ACDD)
+    ('Conventions', 'CF-1.6, ACDD-1.3'),
+    # SUGGESTED - Published or web - based references that describe the data or methods used to produce it.
+    # Recommend URIs(such as a URL or DOI)
+    ('references', 'https://www.hydroffice.org/soundspeed/'),
+    # RECOMMENDED - Provide useful additional information here.(CF)
+    # ('comment', 'Created using HydrOffice %s v.%s' % (ssp_name, ssp_version)),
+    # SUGGESTED - Version identifier of the data file or product as assigned by the data creator. (ACDD)
+    ('product_version', 'Created using HydrOffice %s v.%s' % (ssp_name, ssp_version)),
+])
+
+_PROFILE_ATTRS = OrderedDict([
+    ('long_name', 'Unique identifier for each feature instance'),  # RECOMMENDED
+    ('cf_role', 'profile_id'),  # RECOMMENDED
+])
+
+_TIME_ATTRS = OrderedDict([
+    ('long_name', 'cast time'),  # RECOMMENDED - Provide a descriptive, long name for this variable.
+    ('standard_name', 'time'),  # REQUIRED - Do not change
+    ('units', 'seconds since 1970-01-01 00:00:00'),  # REQUIRED - Use approved CF convention with approved UDUNITS.
+    # ('calendar', 'julian'),  # REQUIRED    - IF the calendar is not default calendar, which is "gregorian".
+    ('axis', 'T'),  # REQUIRED    - Do not change.
+    # ('_FillValue', 0.0),  # REQUIRED  if there could be missing values in the data. >> set at var creation
+    # ('ancillary_variables', ''),  # RECOMMENDED - List other variables providing information about this variable.
+    # ('comment', ''),  # RECOMMENDED - Add useful, additional information here.
+])
+
+_LAT_ATTRS = OrderedDict([
+    ('long_name', 'latitude'),  # RECOMMENDED - Provide a descriptive, long name for this variable.
+    ('standard_name', 'latitude'),  # REQUIRED - Do not change.
+    ('units', 'degrees_north'),  # REQUIRED - CF recommends degrees_north, but at least must use UDUNITS.
+    ('axis', 'Y'),  # REQUIRED - Do not change.
+    ('valid_min', -90.0),  # RECOMMENDED - Replace with correct value.
+    ('valid_max', 180.0),  # RECOMMENDED - Replace with correct value.
+    # ('_FillValue', 180.0),  # REQUIRED if there could be missing values in the data.
+    # ('ancillary_variables', ''),  # RECOMMENDED - List other variables providing information about this variable.
+    # ('comment', ''),  # RECOMMENDED - Add useful, additional information here.
+])
+
+_LON_ATTRS = OrderedDict([
+    ('long_name', 'longitude'),  # RECOMMENDED
+    ('standard_name', 'longitude'),  # REQUIRED - This is fixed, do not change.
+    ('units', 'degrees_east'),  # REQUIRED - CF recommends degrees_east, but at least use UDUNITS.
+    ('axis', 'X'),  # REQUIRED - Do not change.
+    ('valid_min', -180.0),  # RECOMMENDED - Replace this with correct value.
+    ('valid_max', 360.0),  # RECOMMENDED - Replace this with correct value.
+    # ('_FillValue', 360.0),  # REQUIRED if there could be missing values in the data.
+    # ('ancillary_variables', ''),  # RECOMMENDED - List other variables providing information about this variable.
+    # ('comment', ''),  # RECOMMENDED - Add useful, additional information here.
+])
+
+_CRS_ATTRS = OrderedDict([
+    ('grid_mapping_name', 'latitude_longitude'),  # RECOMMENDED
+    ('epsg_code', 'EPSG:4326'),  # RECOMMENDED - European Petroleum Survey Group code for the grid mapping name.
+    ('semi_major_axis', 6378137.0),  # RECOMMENDED
+    ('inverse_flattening', 298.257223563),  # RECOMMENDED
+])
+
+_DEPTH_ATTRS = OrderedDict([
+    # RECOMMENDED - Provide a descriptive, long name for this variable.
+    ('long_name', 'depth in sea water'),
+    # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
+    ('standard_name', 'depth'),
+    ('units', 'm'),
+    ('axis', 'Z'),
+    ('positive', 'down'),
+])
+
+_PRESSURE_ATTRS = OrderedDict([
+    # RECOMMENDED - Provide a descriptive, long name for this variable.
+    ('long_name', 'pressure in sea water'),
+    # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
+    ('standard_name', 'sea_water_pressure'),
+    ('units', 'dbar'),
+])
+
+_TEMPERATURE_ATTRS = OrderedDict([
+    # RECOMMENDED - Provide a descriptive, long name for this variable.
+    ('long_name', 'temperature in sea water'),
+    # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
+    ('standard_name', 'sea_water_temperature'),
+    ('units', 'degree_C'),  # REQUIRED - Use UDUNITS compatible units.
+])
+
+_SALINITY_ATTRS = OrderedDict([
+    # RECOMMENDED - Provide a descriptive, long name for this variable.
+    ('long_name', 'salinity in sea water'),
+    # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
+    ('standard_name', 'sea_water_practical_salinity'),
+    ('units', '1e-3'),  # REQUIRED - Use UDUNITS compatible units.
+])
+
+_CONDUCTIVITY_ATTRS = OrderedDict([
+    # RECOMMENDED - Provide a descriptive, long name for this variable.
+    ('long_name', 'conductivity in sea water'),
+    # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
+    ('standard_name', 'sea_water_electrical_conductivity'),
+    ('units', 'S m-1'),
+])
+
+_SOUND_SPEED_ATTRS = OrderedDict([
+    # RECOMMENDED - Provide a descriptive, long name for this variable.
+    ('long_name', 'sound speed in sea water'),
+    # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
+    ('standard_name', 'speed_of_sound_in_sea_water'),
+    ('units', 'm s-1'),  # REQUIRED - Use UDUNITS compatible units.
+])
+
+_FLAG_ATTRS = OrderedDict([
+    # RECOMMENDED - Provide a descriptive, long name for this variable.
+    ('long_name', 'quality flag'),
+    # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
+    # ('standard_name', ''),
+    ('flag_values', (0, 1)),
+    ('flag_meanings', 'valid invalid'),
+])
 
 
 class Ncei(AbstractWriter):
@@ -22,13 +154,54 @@ class Ncei(AbstractWriter):
     - http://puma.nerc.ac.uk/cgi-bin/cf-checker.pl
     """
 
-    def __init__(self):
+    # minimum number of valid samples to store the z variables as compressed chunks: below it, the chunk index and
+    # filter metadata (about 14 kB per file) outweigh the zlib savings (measured break-even of the file size)
+    min_compressed_samples = 1250
+    # MPI-IO hints used in parallel mode: collective buffering of the writes
+    mpi_hints = {
+        'romio_cb_write': 'enable',
+        'cb_buffer_size': '16777216',
+    }
+
+    def __init__(self, parallel=False, comm=None):
         super(Ncei, self).__init__()
         self.desc = "NCEI"
         self._ext.add('nc')
         self.root_group = None
         self._instrument = None
 
+        # parallel mode: all the processes of the communicator write collectively in the same files
+        self._parallel = parallel
+        self._mpi = None
+        self._comm = None
+        if self._parallel:
+            # imported only when requested, since importing mpi4py initializes MPI
+            try:
+                from mpi4py import MPI
+            except ImportError:
+                raise RuntimeError("NCEI parallel writing requires mpi4py")
+            if not netCDF4.__has_parallel4_support__:
+                raise RuntimeError("NCEI parallel writing requires a netCDF4 library with parallel support")
+            self._mpi = MPI
+            self._comm = MPI.COMM_WORLD if comm is None else comm
+
+        # profiles stored in the output file (along its 'profile' dimension)
+        self._profiles = list()
+        # the content of the output file, prepared before opening it
+        self._payload = None
+        # creation time, shared by all the files of a write call
+        self._date_created = None
+
+        # valid samples of the current profile (cached at each write)
+        self._nz = 0
+        self._depth = None
+        self._pressure = None
+        self._temp = None
+        self._sal = None
+        self._conductivity = None
+        self._speed = None
+        self._flag = None
+
     @property
     def instrument(self):
         return self._instrument
@@ -39,95 +212,171 @@ class Ncei(AbstractWriter):
         self._instrument = value
 
     def write(self, ssp, data_path, data_file=None, project=''):
-        """Writing raw profile data to NetCDF4 file"""
+        """Writing raw profile data to NetCDF4 (classic model) file"""
         # logger.debug('*** %s ***: start' % self.driver)
 
         self.ssp = ssp
         self._project = project
+        self._date_created = self._utc_now()
+        self._profiles = [self.ssp.cur]
+        try:
+            self._cache_valid_data()
+            if self._nz == 0:  # nothing to export: avoid creating an empty file
+                raise RuntimeError("NCEI export error: no valid samples")
+            self._miss_metadata()
 
-        ship_code = self.ssp.cur.meta.vessel[:2] if len(self.ssp.cur.meta.vessel) >= 2 else 'ZZ'
-        nc_file = '%s_%s.nc' % (self.ssp.cur.meta.utc_time.strftime('%Y%m%d%H%M%S'), ship_code)
+            self._write_file(data_path, self._file_name())
 
-        # define the output file path
-        if not os.path.exists(data_path):
-            os.makedirs(data_path)
-        file_path = os.path.join(data_path, nc_file)
+        finally:  # the writer is shared: do not keep the profile data once written
+            self._clear_cache()
 
-        self._miss_metadata()
-        logger.info("output file: %s" % file_path)
+        # logger.debug('*** %s ***: done' % self.driver)
+        return True
 
-        # create the file
-        self.root_group = netCDF4.Dataset(file_path, 'w', format='NETCDF4')
+    def write_many(self, ssps, data_path, project=''):
+        """Writing several raw profiles to NetCDF4 (classic model) files
 
-        self._write_header()
-        self._write_body()
+        The profiles sharing platform, survey, institution and instrument are stored in a single file, following
+        the NCEI orthogonal multidimensional representation (the 'z' dimension is sized on the longest cast).
 
-        self.finalize()
+        In parallel mode, all the processes must pass the same profiles: each file is defined collectively and
+        every process writes its own block of profiles (independently, if there are fewer profiles than processes).
+        """
+        # logger.debug('*** %s ***: start' % self.driver)
+
+        self._project = project
+        self._date_created = self._utc_now()
+
+        groups = OrderedDict()
+        for profile in ssps.l:
+            if not np.any(profile.data_valid):
+                logger.warning("NCEI export skipped for cast at %s: no valid samples" % profile.meta.utc_time)
+                continue
+            meta = profile.meta
+            key = (meta.vessel, meta.survey, meta.institution, meta.sensor, meta.probe, meta.sn)
+            groups.setdefault(key, list()).append(profile)
+        if len(groups) == 0:
+            raise RuntimeError("NCEI export error: no casts with valid samples")
+
+        batches = list()
+        for profiles in groups.values():
+            ssp = ProfileList()
+            for profile in profiles:
+                ssp.append_profile(profile)
+            batches.append(ssp)
+
+        try:
+            # all the casts are validated before writing any file, to avoid a partial export
+            for ssp in batches:
+                self.ssp = ssp
+                self._check_profiles()
+
+            nc_files = list()
+            for ssp in batches:
+                self.ssp = ssp
+                self._cache_many_valid_data()
+
+                nc_files.append(self._file_name(used=nc_files))
+                self._write_file(data_path, nc_files[-1])
+
+        finally:  # the writer is shared: do not keep the profile data once written
+            self._clear_cache()
 
         # logger.debug('*** %s ***: done' % self.driver)
         return True
 
-    def _write_header(self):
-        """Write header"""
+    def _file_name(self, used=()):
+        """Name the output file after the time and the vessel of the current profile
+
+        A numeric suffix is added if the name is among the used ones (e.g., files of the same write_many call).
+        """
+        ship_code = self.ssp.cur.meta.vessel[:2] if len(self.ssp.cur.meta.vessel) >= 2 else 'ZZ'
+        name = '%s_%s' % (self.ssp.cur.meta.utc_time.strftime('%Y%m%d%H%M%S'), ship_code)
+        nc_file = '%s.nc' % name
+        count = 1
+        while nc_file in used:
+            count += 1
+            nc_file = '%s_%d.nc' % (name, count)
+        return nc_file
+
+    def _write_file(self, data_path, nc_file):
+        """Write the cached profiles to the passed file name"""
+        # define the output file path
+        os.makedirs(data_path, exist_ok=True)
+        file_path = os.path.join(data_path, nc_file)
+
+        # all the attributes and values are prepared before opening the file
+        self._payload = self._build_payload()
+
+        logger.info("output file: %s" % file_path)
+        self._flush_payload(file_path)
+
+        self.finalize()
+
+    def _build_payload(self):
+        """Build dimensions, variables (with attributes and values) and global attributes of the output file"""
+        payload = {
+            'dims': OrderedDict(),
+            'vars': OrderedDict(),
+            'attrs': OrderedDict(),
+        }
+        self._build_header_payload(payload)
+        self._build_body_payload(payload)
+        return payload
+
+    def _build_header_payload(self, payload):
         # logger.debug('generating header')
 
-        # set the 'z' dimension and the number of profiles (always 1)
-        self.root_group.createDimension('z', np.sum(self.ssp.cur.data_valid))
-        self.root_group.createDimension('profile', 1)
+        # set the dimensions (following the NCEI orthogonal template, also a single profile has the 'profile' one)
+        payload['dims']['z'] = self._nz
+        payload['dims']['profile'] = len(self._profiles)
+        metas = [profile.meta for profile in self._profiles]
 
         # var: profile
         # RECOMMENDED - If using the attribute below: cf_role. Data type can be whatever is appropriate for the
         # unique feature type.
-        profile_str = "%s %.7f %.7f" % (self.ssp.cur.meta.utc_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
-                                        self.ssp.cur.meta.longitude, self.ssp.cur.meta.latitude)
+        profile_strs = ["%s %.7f %.7f" % (meta.utc_time.strftime('%Y-%m-%dT%H:%M:%SZ'), meta.longitude, meta.latitude)
+                        for meta in metas]
         default_profile_str_length = 64
-        profile_str_length = max(default_profile_str_length, len(profile_str))
-        self.root_group.createDimension('profile_id_length', profile_str_length)
-        profile = self.root_group.createVariable('profile', 'S1', ('profile', 'profile_id_length',))
-        profile[:] = netCDF4.stringtoarr(profile_str, profile_str_length)
-        profile.long_name = 'Unique identifier for each feature instance'  # RECOMMENDED
-        profile.cf_role = 'profile_id'  # RECOMMENDED
+        profile_str_length = max([default_profile_str_length] + [len(profile_str) for profile_str in profile_strs])
+        payload['dims']['profile_id_length'] = profile_str_length
+        payload['vars']['profile'] = {
+            'datatype': 'S1',
+            'dimensions': ('profile', 'profile_id_length',),
+            # the ids are encoded at once in a null-padded fixed-width array, then viewed as characters (no copy)
+            'values': np.array(profile_strs, dtype='S%d' % profile_str_length).view('S1'),
+            'attrs': _PROFILE_ATTRS,
+        }
 
         # var: time
         # Depending on the precision used for the variable, the data type could be int or double instead of float.
-        time = self.root_group.createVariable('time', 'i4', ('profile',), fill_value=0.0)
-        time[:] = int(calendar.timegm(self.ssp.cur.meta.utc_time.timetuple()))
-        time.long_name = 'cast time'  # RECOMMENDED - Provide a descriptive, long name for this variable.
-        time.standard_name = 'time'  # REQUIRED - Do not change
-        time.units = 'seconds since 1970-01-01 00:00:00'  # REQUIRED - Use approved CF convention with approved UDUNITS.
-        # time.calendar = 'julian'  # REQUIRED    - IF the calendar is not default calendar, which is "gregorian".
-        time.axis = 'T'  # REQUIRED    - Do not change.
-        # time._FillValue = 0.0  # REQUIRED  if there could be missing values in the data. >> set at var creation
-        # time.ancillary_variables = ''  # RECOMMENDED - List other variables providing information about this variable.
-        # time.comment = ''  # RECOMMENDED - Add useful, additional information here.
+        payload['vars']['time'] = {
+            'datatype': 'i4',
+            'dimensions': ('profile',),
+            'fill_value': 0.0,
+            'values': np.array([int(meta.utc_time.replace(tzinfo=dt.timezone.utc).timestamp()) for meta in metas]),
+            'attrs': _TIME_ATTRS,
+        }
 
         # var: lat
         # depending on the precision used for the variable, the data type could be int, float or double.
-        lat = self.root_group.createVariable('lat', 'f8', ('profile',), fill_value=180.0)
-        lat[:] = self.ssp.cur.meta.latitude
-        lat.long_name = 'latitude'  # RECOMMENDED - Provide a descriptive, long name for this variable.
-        lat.standard_name = 'latitude'  # REQUIRED - Do not change.
-        lat.units = 'degrees_north'  # REQUIRED - CF recommends degrees_north, but at least must use UDUNITS.
-        lat.axis = 'Y'  # REQUIRED - Do not change.
-        lat.valid_min = -90.0  # RECOMMENDED - Replace with correct value.
-        lat.valid_max = 180.0  # RECOMMENDED - Replace with correct value.
-        # lat._FillValue = 180.0  # REQUIRED if there could be missing values in the data.
-        # lat.ancillary_variables = ''  # RECOMMENDED - List other variables providing information about this variable.
-        # lat.comment = ''  # RECOMMENDED - Add useful, additional information here.
+        payload['vars']['lat'] = {
+            'datatype': 'f8',
+            'dimensions': ('profile',),
+            'fill_value': 180.0,
+            'values': np.array([meta.latitude for meta in metas]),
+            'attrs': _LAT_ATTRS,
+        }
 
         # var: lon
         # Depending on the precision used for the variable, the data type could be int, float or double.
-        lon = self.root_group.createVariable('lon', 'f8', ('profile',), fill_value=360.0)
-        lon[:] = self.ssp.cur.meta.longitude
-        lon.long_name = 'longitude'  # RECOMMENDED
-        lon.standard_name = 'longitude'  # REQUIRED - This is fixed, do not change.
-        lon.units = 'degrees_east'  # REQUIRED - CF recommends degrees_east, but at least use UDUNITS.
-        lon.axis = 'X'  # REQUIRED - Do not change.
-        lon.valid_min = -180.0  # RECOMMENDED - Replace this with correct value.
-        lon.valid_max = 360.0  # RECOMMENDED - Replace this with correct value.
-        # lon:_FillValue = 360.0 # REQUIRED if there could be missing values in the data.
-        # lon.ancillary_variables = ''  # RECOMMENDED - List other variables providing information about this variable.
-        # lon.comment = ''  # RECOMMENDED - Add useful, additional information here.
+        payload['vars']['lon'] = {
+            'datatype': 'f8',
+            'dimensions': ('profile',),
+            'fill_value': 360.0,
+            'values': np.array([meta.longitude for meta in metas]),
+            'attrs': _LON_ATTRS,
+        }
 
         # var: crs
         # RECOMMENDED - A container variable storing information about the grid_mapping.
@@ -136,178 +385,320 @@ class Ncei(AbstractWriter):
         # and-projections.
         # For all the measurements based on WSG84, the default coordinate system used for GPS measurements,
         # the values shown here should be used.
-        crs = self.root_group.createVariable('crs', 'f8', ('profile',))
-        crs[:] = 4326.0
-        crs.grid_mapping_name = 'latitude_longitude'  # RECOMMENDED
-        crs.epsg_code = 'EPSG:4326'  # RECOMMENDED - European Petroleum Survey Group code for the grid mapping name.
-        crs.semi_major_axis = 6378137.0  # RECOMMENDED
-        crs.inverse_flattening = 298.257223563  # RECOMMENDED
+        payload['vars']['crs'] = {
+            'datatype': 'f8',
+            'dimensions': ('profile',),
+            'values': np.full(len(self._profiles), 4326.0),
+            'attrs': _CRS_ATTRS,
+        }
 
         # global attributes:
-        self.root_group.ncei_template_version = 'NCEI_NetCDF_Profile_Orthogonal_Template_v2.0'  # REQUIRED(NCEI)
-        self.root_group.featureType = 'profile'  # REQUIRED - CF attribute for identifying the featureType.(CF)
-        # SUGGESTED - The data type, as derived from Unidata's Common Data Model Scientific Data types and understood
-        # by THREDDS. (ACDD)
-        self.root_group.cdm_data_type = 'profile'
-        # HIGHLY RECOMMENDED - Provide a useful title for the data in the file.(ACDD)
-        self.root_group.title = '%s_%s profile' % (self.ssp.cur.meta.sensor, self.ssp.cur.meta.probe)
-        # HIGHLY RECOMMENDED - Provide a useful summary or abstract for the data in the file.(ACDD)
-        # self.root_group.summary = ''
-        # HIGHLY RECOMMENDED - A comma separated list of keywords coming from the keywords_vocabulary.(ACDD)
-        # self.root_group.keywords = ''
-        # HIGHLY RECOMMENDED - A comma separated list of the conventions being followed. Always try to use latest
-        # version.(CF / ACDD)
-        self.root_group.Conventions = 'CF-1.6, ACDD-1.3'
-        # RECOMMENDED - Creation date of this version of the data(netCDF).  Use ISO 8601:2004 for date and time. (ACDD)
-        self.root_group.date_created = '%s' % dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-        self.root_group.survey = '%s' % self.ssp.cur.meta.survey
-        # RECOMMENDED - The name of the project(s) principally responsible for originating this data.
-        # Multiple projects can be separated by commas.(ACDD)
-        self.root_group.project = '%s' % self._project
-        # SUGGESTED - Name of the platform(s) that supported the sensor data used to create this data set or product.
-        # Platforms can be of any type, including satellite, ship, station, aircraft or other.(ACDD)
+        meta = self.ssp.cur.meta
         # Match platform format with velocipy
-        platform = str(self.ssp.cur.meta.vessel).upper()
+        platform = str(meta.vessel).upper()
         platform = platform.replace('NRT-', 'NOAA NAVIGATION RESPONSE TEAM-')
         if len(platform) > 2 and platform[:2] in ['RA', 'TJ', 'FH', 'FA']:
             platform = platform.replace('(SHIP)', 'NOAA SHIP')
-        self.root_group.platform = '%s' % platform
-        # RECOMMENDED -The name of the institution principally responsible for originating this data..  An institution
-        # attribute can be used for each variable if variables come from more than one institution. (CF/ACDD)
-        self.root_group.institution = '%s' % self.ssp.cur.meta.institution
+        meta_attrs = OrderedDict([
+            # HIGHLY RECOMMENDED - Provide a useful title for the data in the file.(ACDD)
+            ('title', '%s_%s profile' % (meta.sensor, meta.probe)),
+            # RECOMMENDED - Creation date of this version of the data(netCDF).  Use ISO 8601:2004 for date and time.
+            # (ACDD)
+            ('date_created', self._date_created),
+            ('survey', str(meta.survey)),
+            # RECOMMENDED - The name of the project(s) principally responsible for originating this data.
+            # Multiple projects can be separated by commas.(ACDD)
+            ('project', str(self._project)),
+            # SUGGESTED - Name of the platform(s) that supported the sensor data used to create this data set or
+            # product. Platforms can be of any type, including satellite, ship, station, aircraft or other.(ACDD)
+            ('platform', platform),
+            # RECOMMENDED -The name of the institution principally responsible for originating this data..  An
+            # institution attribute can be used for each variable if variables come from more than one institution.
+            # (CF/ACDD)
+            ('institution', str(meta.institution)),
+        ])
+        payload['attrs'] = OrderedDict(_GLOBAL_ATTRS)
+        payload['attrs'].update(meta_attrs)
+
         # RECOMMENDED - an instrument variable storing information about a parameter of the instrument used in the
         # measurement, the dimensions don't have to be specified if the same instrument is used for all the measurements.
-        instrument = self.root_group.createVariable('instrument', 'i4')
+        instrument_attrs = OrderedDict()
         if self._instrument is None:
 
-            instrument.long_name = '%s' % self.ssp.cur.meta.sensor
+            instrument_attrs['long_name'] = str(self.ssp.cur.meta.sensor)
             probe = str(self.ssp.cur.meta.probe)
             sn = str(self.ssp.cur.meta.sn)
             match = re.match('^(\w+?) ?\(SN:(\w+?)\)', sn)
             if match:
                 probe = match.group(1)
                 sn = match.group(2)
-            instrument.make_model = '%s' % probe
+            instrument_attrs['make_model'] = probe
             if self.ssp.cur.meta.sn:
-                instrument.serial_number = '%s' % sn
+                instrument_attrs['serial_number'] = sn
 
         else:  # this part is used when a custom instrument is passed (for instance, for ISS format)
 
             tokens = self._instrument.split()
             if len(tokens) > 0:
-                instrument.long_name = self._instrument.split()[0]
+                instrument_attrs['long_name'] = self._instrument.split()[0]
             if len(tokens) > 1:
-                instrument.make_model = self._instrument.split()[1]
+                instrument_attrs['make_model'] = self._instrument.split()[1]
             if self.ssp.cur.meta.sn:
-                instrument.serial_number = '%s' % self.ssp.cur.meta.sn
-
-        # SUGGESTED - Published or web - based references that describe the data or methods used to produce it.
-        # Recommend URIs(such as a URL or DOI)
-        self.root_group.references = 'https://www.hydroffice.org/soundspeed/'
-        # RECOMMENDED - Provide useful additional information here.(CF)
-        # self.root_group.comment = b'Created using HydrOffice %s v.%s' % (ssp_name, ssp_version)
-        # SUGGESTED - Version identifier of the data file or product as assigned by the data creator. (ACDD)
-        self.root_group.product_version = 'Created using HydrOffice %s v.%s' % (ssp_name, ssp_version)
-
-    def _write_body(self):
+                instrument_attrs['serial_number'] = str(self.ssp.cur.meta.sn)
+        payload['vars']['instrument'] = {
+            'datatype': 'i4',
+            'dimensions': (),
+            # container variable: explicitly set to the default fill value (read as missing), since the file is
+            # written with the fill mode off
+            'values': np.array(netCDF4.default_fillvals['i4']),
+            'attrs': instrument_attrs,
+        }
+
+    def _build_body_payload(self, payload):
         # logger.debug('generating body')
 
-        # valid indices
-        vi = self.ssp.cur.data_valid
+        z_dims = ('profile', 'z',)
 
         # var: depth
-        if self._not_empty(self.ssp.cur.data.depth[vi]):
-            depth = self.root_group.createVariable('depth', 'f4', ('profile', 'z',))
-            depth[:] = self.ssp.cur.data.depth[vi]
-            # RECOMMENDED - Provide a descriptive, long name for this variable.
-            depth.long_name = 'depth in sea water'
-            # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
-            depth.standard_name = 'depth'
-            depth.units = 'm'
-            depth.axis = 'Z'
-            depth.positive = 'down'
+        if self._not_empty(self._depth):
+            payload['vars']['depth'] = {
+                'datatype': 'f4',
+                'dimensions': z_dims,
+                'values': self._depth,
+                'attrs': _DEPTH_ATTRS,
+            }
 
         # var: pressure
-        if self._not_empty(self.ssp.cur.data.pressure[vi]):
-            pressure = self.root_group.createVariable('pressure', 'f4', ('profile', 'z',))
-            pressure[:] = self.ssp.cur.data.pressure[vi]
-            # RECOMMENDED - Provide a descriptive, long name for this variable.
-            pressure.long_name = 'pressure in sea water'
-            # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
-            pressure.standard_name = 'sea_water_pressure'
-            pressure.units = 'dbar'
+        if self._not_empty(self._pressure):
+            payload['vars']['pressure'] = {
+                'datatype': 'f4',
+                'dimensions': z_dims,
+                'values': self._pressure,
+                'attrs': _PRESSURE_ATTRS,
+            }
 
         # var: temperature
-        if self._not_empty(self.ssp.cur.data.temp[vi]):
-            temperature = self.root_group.createVariable('temperature', 'f4', ('profile', 'z',))
-            temperature[:] = self.ssp.cur.data.temp[vi]
-            # RECOMMENDED - Provide a descriptive, long name for this variable.
-            temperature.long_name = 'temperature in sea water'
-            # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
-            temperature.standard_name = 'sea_water_temperature'
-            temperature.units = 'degree_C'  # REQUIRED - Use UDUNITS compatible units.
+        if self._not_empty(self._temp):
+            payload['vars']['temperature'] = {
+                'datatype': 'f4',
+                'dimensions': z_dims,
+                'values': self._temp,
+                'attrs': _TEMPERATURE_ATTRS,
+            }
 
         # var: salinity
-        if self._not_empty(self.ssp.cur.data.sal[vi]):
-            salinity = self.root_group.createVariable('salinity', 'f4', ('profile', 'z',))
-            salinity[:] = self.ssp.cur.data.sal[vi]
-            # RECOMMENDED - Provide a descriptive, long name for this variable.
-            salinity.long_name = 'salinity in sea water'
-            # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
-            salinity.standard_name = 'sea_water_practical_salinity'
-            salinity.units = '1e-3'  # REQUIRED - Use UDUNITS compatible units.
+        if self._not_empty(self._sal):
+            payload['vars']['salinity'] = {
+                'datatype': 'f4',
+                'dimensions': z_dims,
+                'values': self._sal,
+                'attrs': _SALINITY_ATTRS,
+            }
 
         # var: conductivity
-        if self._not_empty(self.ssp.cur.data.conductivity[vi]):
-            conductivity = self.root_group.createVariable('conductivity', 'f4', ('profile', 'z',))
-            conductivity[:] = self.ssp.cur.data.conductivity[vi]
-            # RECOMMENDED - Provide a descriptive, long name for this variable.
-            conductivity.long_name = 'conductivity in sea water'
-            # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
-            conductivity.standard_name = 'sea_water_electrical_conductivity'
-            conductivity.units = 'S m-1'
+        if self._not_empty(self._conductivity):
+            payload['vars']['conductivity'] = {
+                'datatype': 'f4',
+                'dimensions': z_dims,
+                'values': self._conductivity,
+                'attrs': _CONDUCTIVITY_ATTRS,
+            }
 
         # var: sound speed
-        if self._not_empty(self.ssp.cur.data.speed[vi]):
-            sound_speed = self.root_group.createVariable('sound_speed', 'f4', ('profile', 'z',))
-            sound_speed[:] = self.ssp.cur.data.speed[vi]
-            # RECOMMENDED - Provide a descriptive, long name for this variable.
-            sound_speed.long_name = 'sound speed in sea water'
-            # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
-            sound_speed.standard_name = 'speed_of_sound_in_sea_water'
-            sound_speed.units = 'm s-1'  # REQUIRED - Use UDUNITS compatible units.
+        if self._not_empty(self._speed):
+            payload['vars']['sound_speed'] = {
+                'datatype': 'f4',
+                'dimensions': z_dims,
+                'values': self._speed,
+                'attrs': _SOUND_SPEED_ATTRS,
+            }
 
         # var: flag
         if True:
-            flag = self.root_group.createVariable('flag', 'i4', ('profile', 'z',))
-            flag[:] = self.ssp.cur.data.flag[vi]
-            # RECOMMENDED - Provide a descriptive, long name for this variable.
-            flag.long_name = 'quality flag'
-            # REQUIRED - If using a CF standard name and a suitable name exists in the CF standard name table.
-            # flag.standard_name = ''
-            flag.flag_values = 0, 1
-            flag.flag_meanings = 'valid invalid'
+            payload['vars']['flag'] = {
+                'datatype': 'i4',
+                'dimensions': z_dims,
+                'values': self._flag,
+                'attrs': _FLAG_ATTRS,
+            }
+
+    def _flush_payload(self, file_path):
+        """Write the pre-built payload to a new file, keeping it open only for the netCDF calls"""
+        # create the file
+        if self._parallel:
+            info = self._mpi.Info.Create()
+            try:
+                for key, value in self.mpi_hints.items():
+                    info.Set(key, value)
+                self.root_group = netCDF4.Dataset(file_path, 'w', format='NETCDF4_CLASSIC', parallel=True,
+                                                  comm=self._comm, info=info)
+            finally:  # the hints are copied at the file creation
+                info.Free()
+        else:
+            self.root_group = netCDF4.Dataset(file_path, 'w', format='NETCDF4_CLASSIC')
+        try:
+            # no pre-fill pass: every variable is fully written (the padding of shorter casts and the 'instrument'
+            # container variable are explicitly set to the fill values)
+            self.root_group.set_fill_off()
+            self.root_group.set_auto_mask(False)  # plain arrays are assigned: no need for masking them
+
+            self._write_header()
+            self._write_body()
+
+        finally:  # the file is closed exactly once, also when the writing fails
+            self.root_group.close()
+            self.root_group = None
+
+    def _write_header(self):
+        """Write dimensions, global attributes and all the variables not along the 'z' dimension"""
+        for name, size in self._payload['dims'].items():
+            self.root_group.createDimension(name, size)
+
+        for name, var in self._payload['vars'].items():
+            if 'z' in var['dimensions']:
+                continue
+            variable = self.root_group.createVariable(name, var['datatype'], var['dimensions'],
+                                                      fill_value=var.get('fill_value'))
+            variable.setncatts(var['attrs'])
 
-        self.root_group.close()
+        self.root_group.setncatts(self._payload['attrs'])
+
+    def _write_body(self):
+        """Write the 'z' variables, then assign the values of all the variables in a single pass"""
+        for name, var in self._payload['vars'].items():
+            if 'z' not in var['dimensions']:
+                continue
+            variable = self._create_z_variable(name, var['datatype'])
+            variable.setncatts(var['attrs'])
+
+        # the profile arrays are float64: cast them once to the variable type (f4/i4) to skip the library conversion
+        rows = self._profile_rows()
+        collective = self._collective()
+        for name, var in self._payload['vars'].items():
+            variable = self.root_group.variables[name]
+            values = var['values'].astype(variable.dtype, copy=False).reshape(variable.shape)
+            along_profile = variable.dimensions[:1] == ('profile',)
+            if self._parallel:  # the variables not along 'profile' are fully written by all the processes
+                variable.set_collective(collective or not along_profile)
+            if along_profile:
+                variable[rows] = values[rows]
+            else:
+                variable[:] = values
+
+    def _profile_rows(self):
+        """Profiles written by this process: a contiguous block of them in parallel mode, otherwise all"""
+        if not self._parallel:
+            return slice(None)
+
+        nr_profiles = len(self._profiles)
+        size, rank = self._comm.Get_size(), self._comm.Get_rank()
+        block, extra = divmod(nr_profiles, size)
+        start = rank * block + min(rank, extra)
+        stop = start + block + (1 if rank < extra else 0)
+        return slice(start, stop)
+
+    def _collective(self):
+        """Whether the profiles are written collectively: only in parallel mode, with profiles for every process
+
+        A process without profiles cannot join a collective write, since netCDF4-python skips the empty writes.
+        """
+        return self._parallel and (len(self._profiles) >= self._comm.Get_size())
+
+    def _create_z_variable(self, name, datatype):
+        """Create a z variable, stored as compressed chunks (one per profile) when the profiles are long enough"""
+        # for short profiles, the chunk overhead dominates; in parallel mode, only the collective writes can compress
+        if (self._nz < self.min_compressed_samples) or (self._parallel and not self._collective()):
+            return self.root_group.createVariable(name, datatype, ('profile', 'z',))
+
+        variable = self.root_group.createVariable(name, datatype, ('profile', 'z',), zlib=True, shuffle=True,
+                                                  complevel=4, chunksizes=(1, self._nz))
+        # a profile is a single chunk: cache exactly that chunk and never evict it before the close
+        variable.set_var_chunk_cache(size=self._nz * np.dtype(datatype).itemsize, nelems=1, preemption=0.0)
+        return variable
+
+    def _utc_now(self):
+        now = dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if self._parallel:
+            # the global attributes are written collectively: all the processes must use the clock of the root one
+            now = self._comm.bcast(now, root=0)
+        return now
 
     def _is_empty(self, data):
-        return data.min() == data.max()
+        return not self._not_empty(data)
 
     def _not_empty(self, data):
-        return data.min() != data.max()
+        # a single comparison pass against the first sample (instead of a min and a max scan)
+        return (data.size > 0) and bool(np.any(data != data.flat[0]))
+
+    def _cache_valid_data(self):
+        """Extract once the valid samples of the current profile, to be reused by header and body"""
+        vi = np.flatnonzero(self.ssp.cur.data_valid)
+        self._nz = vi.size
+        data = self.ssp.cur.data
+        self._depth = data.depth[vi]
+        self._pressure = data.pressure[vi]
+        self._temp = data.temp[vi]
+        self._sal = data.sal[vi]
+        self._conductivity = data.conductivity[vi]
+        self._speed = data.speed[vi]
+        self._flag = data.flag[vi]
+
+    def _check_profiles(self):
+        """Validate the metadata and the valid samples of all the profiles"""
+        for idx in range(self.ssp.nr_profiles):
+            self.ssp.current_index = idx
+            self._cache_valid_data()
+            self._miss_metadata()
+        self.ssp.current_index = 0
+
+    def _cache_many_valid_data(self):
+        """Extract the valid samples of all the profiles, padded with fill values to the longest cast"""
+        fields = ('depth', 'pressure', 'temp', 'sal', 'conductivity', 'speed', 'flag')
+        valid = {field: list() for field in fields}
+        for idx in range(self.ssp.nr_profiles):
+            self.ssp.current_index = idx
+            self._cache_valid_data()
+            for field in fields:
+                valid[field].append(getattr(self, '_%s' % field))
+        self.ssp.current_index = 0  # the first profile provides the file name and the common metadata
+
+        self._profiles = self.ssp.l
+        self._nz = max(values.size for values in valid['flag'])
+        for field in fields:
+            # the padding is explicitly written since the file is created with the fill mode off
+            fill_value = netCDF4.default_fillvals['i4' if field == 'flag' else 'f4']
+            padded = np.full((self.ssp.nr_profiles, self._nz), fill_value, dtype=np.float64)
+            for row, values in enumerate(valid[field]):
+                # as in a single-profile file, a variable without data in a profile is left missing
+                if (field == 'flag') or self._not_empty(values):
+                    padded[row, :values.size] = values
+            setattr(self, '_%s' % field, padded)
+
+    def _clear_cache(self):
+        """Release the profiles, their cached samples and the payload of the last written file"""
+        self.ssp = None
+        self._profiles = list()
+        self._payload = None
+        self._nz = 0
+        self._depth = None
+        self._pressure = None
+        self._temp = None
+        self._sal = None
+        self._conductivity = None
+        self._speed = None
+        self._flag = None
 
     def _miss_metadata(self):
-        vi = self.ssp.cur.data_valid
         msg = 'NCEI export error: '
 
         if self.ssp.cur.meta.sensor_type == Dicts.sensor_types['Unknown'] or \
                 self.ssp.cur.meta.sensor_type == Dicts.sensor_types['Synthetic']:
             msg = '%s cannot export from sensor - %s, probe - %s' % (
             msg, self.ssp.cur.meta.sensor, self.ssp.cur.meta.probe)
-        elif self._is_empty(self.ssp.cur.data.depth[vi]) and self._is_empty(self.ssp.cur.data.pressure[vi]):
+        elif self._is_empty(self._depth) and self._is_empty(self._pressure):
             msg = '%s missing depth or pressure' % msg
-        elif self._is_empty(self.ssp.cur.data.speed[vi]) and self._is_empty(self.ssp.cur.data.temp[vi]) and \
-                self._is_empty(self.ssp.cur.data.conductivity[vi]) and self._is_empty(self.ssp.cur.data.sal[vi]):
+        elif self._is_empty(self._speed) and self._is_empty(self._temp) and \
+                self._is_empty(self._conductivity) and self._is_empty(self._sal):
             msg = '%s missing critical data' % msg
         elif self._project in ['', 'default']:
             msg = '%s project name is not valid' % msg
@@ -0,0 +1,267 @@
+import unittest
+import os
+import shutil
+import tempfile
+import logging
+from datetime import datetime
+
+import numpy as np
+import netCDF4
+
+from hyo2.soundspeed.formats.writers.ncei import Ncei
+from hyo2.soundspeed.profile.dicts import Dicts
+from hyo2.soundspeed.profile.profilelist import ProfileList
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class FakeComm(object):
+    """Minimal MPI communicator, returning the size and the rank of a process"""
+
+    def __init__(self, size, rank):
+        self._size = size
+        self._rank = rank
+
+    def Get_size(self):
+        return self._size
+
+    def Get_rank(self):
+        return self._rank
+
+    def bcast(self, obj, root=0):
+        return obj
+
+
+class FakeVariable(object):
+    """Records the writes to a variable, skipping the empty ones as netCDF4-python does"""
+
+    def __init__(self, name, datatype, dimensions, shape, compressed, writes):
+        self.name = name
+        self.dtype = np.dtype(datatype)
+        self.dimensions = dimensions
+        self.shape = shape
+        self.ndim = len(shape)
+        self.compressed = compressed
+        self.collective = False
+        self._writes = writes
+
+    def setncatts(self, attrs):
+        pass
+
+    def set_var_chunk_cache(self, **kwargs):
+        pass
+
+    def set_collective(self, value):
+        self.collective = value
+
+    def __setitem__(self, key, value):
+        if np.size(value) == 0:  # nothing to write
+            return
+        rows = list(range(self.shape[0]))[key] if self.ndim > 0 else list()
+        self._writes.append((self.name, self.collective, self.compressed, rows))
+
+
+class FakeDataset(object):
+    """Minimal netCDF4 dataset, recording the writes of a process"""
+
+    def __init__(self):
+        self.dimensions = dict()
+        self.variables = dict()
+        self.writes = list()
+
+    def createDimension(self, name, size):
+        self.dimensions[name] = size
+
+    def createVariable(self, name, datatype, dimensions, fill_value=None, zlib=False, **kwargs):
+        shape = tuple(self.dimensions[dim] for dim in dimensions)
+        self.variables[name] = FakeVariable(name, datatype, dimensions, shape, zlib, self.writes)
+        return self.variables[name]
+
+    def setncatts(self, attrs):
+        pass
+
+
+class TestSoundSpeedNcei(unittest.TestCase):
+
+    def setUp(self):
+        self.data_output = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_output, ignore_errors=True)
+
+    @staticmethod
+    def _add_cast(ssps, num_samples, utc_time, latitude, sensor='CTD'):
+        ssps.append()
+        ssps.cur.meta.sensor_type = Dicts.sensor_types[sensor]
+        ssps.cur.meta.utc_time = utc_time
+        ssps.cur.meta.latitude = latitude
+        ssps.cur.meta.longitude = -70.0
+        ssps.cur.meta.vessel = 'RA Rainier'
+        ssps.cur.meta.survey = 'H12345'
+        ssps.cur.meta.institution = 'NOAA'
+        ssps.cur.init_data(num_samples)
+        ssps.cur.data.depth[:] = np.arange(num_samples)
+        ssps.cur.data.speed[:] = np.linspace(1500.0, 1480.0, num_samples)
+        ssps.cur.data.temp[:] = np.linspace(12.0, 4.0, num_samples)
+        ssps.cur.data.sal[:] = np.linspace(34.0, 35.0, num_samples)
+        return ssps.cur
+
+    def test_write_round_trip(self):
+        ssps = ProfileList()
+        cast = self._add_cast(ssps, num_samples=10, utc_time=datetime(2020, 1, 2, 3, 4, 5), latitude=43.0)
+        cast.data.flag[4] = Dicts.flags['user']  # 9 valid samples
+
+        self.assertTrue(Ncei().write(ssps, self.data_output, project='unittest'))
+        self.assertEqual(os.listdir(self.data_output), ['20200102030405_RA.nc'])
+
+        with netCDF4.Dataset(os.path.join(self.data_output, '20200102030405_RA.nc')) as nc:
+            self.assertEqual(len(nc.dimensions['profile']), 1)
+            self.assertEqual(len(nc.dimensions['z']), 9)
+            for name in ('time', 'lat', 'lon', 'crs'):
+                self.assertEqual(nc.variables[name].dimensions, ('profile',))
+            self.assertEqual(int(nc.variables['time'][0]), 1577934245)
+            np.testing.assert_allclose(nc.variables['lat'][:], [43.0])
+            np.testing.assert_allclose(nc.variables['lon'][:], [-70.0])
+            self.assertEqual(netCDF4.chartostring(nc.variables['profile'][:])[0],
+                             '2020-01-02T03:04:05Z -70.0000000 43.0000000')
+
+            depth = nc.variables['depth']
+            self.assertEqual(depth.dimensions, ('profile', 'z'))
+            self.assertEqual(depth.chunking(), 'contiguous')
+            np.testing.assert_allclose(depth[0], [0, 1, 2, 3, 5, 6, 7, 8, 9])
+            np.testing.assert_allclose(nc.variables['sound_speed'][0], np.delete(cast.data.speed, 4), rtol=1e-6)
+            np.testing.assert_array_equal(nc.variables['flag'][0], np.zeros(9))
+            self.assertNotIn('pressure', nc.variables)  # no pressure in the cast
+
+            self.assertTrue(np.ma.is_masked(nc.variables['instrument'][:]))
+            self.assertEqual(nc.variables['instrument'].long_name, 'CTD')
+
+    def test_write_compressed(self):
+        ssps = ProfileList()
+        self._add_cast(ssps, num_samples=Ncei.min_compressed_samples, utc_time=datetime(2020, 1, 2, 3, 4, 5),
+                       latitude=43.0)
+
+        Ncei().write(ssps, self.data_output, project='unittest')
+
+        with netCDF4.Dataset(os.path.join(self.data_output, '20200102030405_RA.nc')) as nc:
+            depth = nc.variables['depth']
+            self.assertEqual(depth.chunking(), [1, Ncei.min_compressed_samples])
+            self.assertTrue(depth.filters()['zlib'])
+            np.testing.assert_allclose(depth[0], ssps.cur.data.depth)
+
+    def test_write_without_valid_samples(self):
+        ssps = ProfileList()
+        cast = self._add_cast(ssps, num_samples=10, utc_time=datetime(2020, 1, 2, 3, 4, 5), latitude=43.0)
+        cast.data.flag[:] = Dicts.flags['user']
+        data_path = os.path.join(self.data_output, 'ncei')
+
+        with self.assertRaises(RuntimeError):
+            Ncei().write(ssps, data_path, project='unittest')
+        self.assertFalse(os.path.exists(data_path))
+
+    def test_write_many_round_trip(self):
+        t0 = datetime(2020, 1, 2, 3, 4, 5)
+        ssps = ProfileList()
+        first = self._add_cast(ssps, num_samples=10, utc_time=t0, latitude=43.0)
+        first.data.flag[4] = Dicts.flags['user']  # 9 valid samples
+        second = self._add_cast(ssps, num_samples=6, utc_time=datetime(2020, 1, 2, 5, 0, 0), latitude=43.5)
+        second.data.sal[:] = 0.0  # no salinity in this cast
+        empty = self._add_cast(ssps, num_samples=5, utc_time=datetime(2020, 1, 2, 6, 0, 0), latitude=44.0)
+        empty.data.flag[:] = Dicts.flags['user']  # no valid samples: skipped
+        # another instrument, with the same time and vessel of the first cast
+        self._add_cast(ssps, num_samples=3, utc_time=t0, latitude=42.0, sensor='XBT')
+
+        writer = Ncei()
+        self.assertTrue(writer.write_many(ssps, self.data_output, project='unittest'))
+        # no data of the last batch is kept by the writer
+        self.assertIsNone(writer.ssp)
+        self.assertIsNone(writer._payload)
+        self.assertIsNone(writer._depth)
+        self.assertEqual(sorted(os.listdir(self.data_output)), ['20200102030405_RA.nc', '20200102030405_RA_2.nc'])
+
+        with netCDF4.Dataset(os.path.join(self.data_output, '20200102030405_RA.nc')) as nc:
+            self.assertEqual(len(nc.dimensions['profile']), 2)
+            self.assertEqual(len(nc.dimensions['z']), 9)
+            for name in ('time', 'lat', 'lon'):
+                self.assertEqual(nc.variables[name].dimensions, ('profile',))
+            np.testing.assert_allclose(nc.variables['lat'][:], [43.0, 43.5])
+            self.assertEqual(int(nc.variables['time'][1] - nc.variables['time'][0]), 6955)
+
+            depth = nc.variables['depth'][:]
+            self.assertEqual(depth.shape, (2, 9))
+            np.testing.assert_allclose(depth[0], [0, 1, 2, 3, 5, 6, 7, 8, 9])
+            np.testing.assert_allclose(depth[1, :6], np.arange(6))
+            self.assertTrue(np.all(depth.mask[1, 6:]))
+            self.assertFalse(np.any(depth.mask[0]))
+
+            salinity = nc.variables['salinity'][:]
+            self.assertFalse(np.any(salinity.mask[0]))
+            self.assertTrue(np.all(salinity.mask[1]))
+
+            self.assertTrue(np.all(nc.variables['flag'][:].mask[1, 6:]))
+
+        with netCDF4.Dataset(os.path.join(self.data_output, '20200102030405_RA_2.nc')) as nc:
+            self.assertEqual(len(nc.dimensions['profile']), 1)
+            self.assertEqual(len(nc.dimensions['z']), 3)
+
+    def test_write_many_invalid_cast(self):
+        ssps = ProfileList()
+        self._add_cast(ssps, num_samples=10, utc_time=datetime(2020, 1, 2, 3, 4, 5), latitude=43.0)
+        self._add_cast(ssps, num_samples=10, utc_time=datetime(2020, 1, 2, 5, 0, 0), latitude=43.5, sensor='XBT')
+        ssps.cur.data.depth[:] = 0.0  # no depth in the cast of the last file
+
+        with self.assertRaises(RuntimeError):
+            Ncei().write_many(ssps, self.data_output, project='unittest')
+        self.assertEqual(os.listdir(self.data_output), list())
+
+    @staticmethod
+    def _parallel_writes(ssps, size):
+        """Write the profiles as each one of the 'size' processes would do, recording their non-empty writes"""
+        writes = list()
+        for rank in range(size):
+            writer = Ncei()
+            writer._parallel = True
+            writer._comm = FakeComm(size=size, rank=rank)
+            writer._project = 'unittest'
+            writer._date_created = '2020-01-02T03:04:05Z'
+            writer.ssp = ssps
+            writer._cache_many_valid_data()
+            writer._payload = writer._build_payload()
+            writer.root_group = FakeDataset()
+            writer._write_header()
+            writer._write_body()
+            writes.append(writer.root_group.writes)
+        return writes
+
+    def test_parallel_writes(self):
+        for nr_profiles, size in [(1, 1), (1, 4), (2, 5), (4, 4), (7, 3)]:
+            ssps = ProfileList()
+            for idx in range(nr_profiles):
+                self._add_cast(ssps, num_samples=Ncei.min_compressed_samples, utc_time=datetime(2020, 1, 2, idx),
+                               latitude=43.0)
+            writes = self._parallel_writes(ssps, size=size)
+
+            # every collective write must be joined by all the processes, in the same order
+            collective = [[name for name, is_collective, _, _ in rank_writes if is_collective]
+                          for rank_writes in writes]
+            for rank_collective in collective:
+                self.assertEqual(rank_collective, collective[0], "%d profiles, %d processes" % (nr_profiles, size))
+            # only the collective writes can be compressed
+            for rank_writes in writes:
+                for name, is_collective, compressed, _ in rank_writes:
+                    self.assertTrue(is_collective or not compressed, name)
+            # the profiles are compressed and collectively written only if every process has some of them
+            self.assertEqual('depth' in collective[0], nr_profiles >= size)
+
+            # each profile is written by exactly one process
+            for name in ('time', 'depth', 'flag'):
+                rows = sorted(row for rank_writes in writes for var_name, _, _, var_rows in rank_writes
+                              if var_name == name for row in var_rows)
+                self.assertEqual(rows, list(range(nr_profiles)), name)
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSoundSpeedNcei))
+    return s